@@ -1,80 +1,270 @@
+from __future__ import annotations
+
 import os
+import atexit
+import hashlib
+import json
+import queue
 import sqlite3
+import threading
+import time
 from datetime import datetime
 
 # Path to analytics SQLite database (ensure the 'instance' directory exists)
 DB_PATH = os.getenv('ANALYTICS_DB_PATH', 'instance/analytics.db')
 
+# Per-connection tuning: WAL lets readers run alongside the writer, and
+# synchronous=NORMAL avoids an fsync on every commit (safe under WAL).
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=3000",
+)
+
+# How often the long-lived connection refreshes query planner statistics
+OPTIMIZE_INTERVAL = 3600
+
+# Single long-lived connection shared by all writers, guarded by a lock
+_CONN = None
+_CONN_LOCK = threading.Lock()
+
+# Analytics events are queued and written in batches by a background thread
+FLUSH_MAX_EVENTS = 500
+FLUSH_INTERVAL = 0.25
+_EVT_Q: queue.Queue = queue.Queue(maxsize=10000)
+_FLUSHER = None
+_FLUSHER_LOCK = threading.Lock()
+
+INSERT_SQL = {
+    'login': '''INSERT INTO logins
+                (timestamp, service, token_type, expires_at, scope, token_hash)
+                VALUES (?, ?, ?, ?, ?, ?)''',
+    'rec': '''INSERT INTO recommendations
+              (session_id, timestamp, service, playlist_id, recommendation, details, language, outcome, error_message)
+              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+}
+
+LOGINS_COLUMNS = '''(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    service TEXT NOT NULL,
+    token_type TEXT,
+    expires_at INTEGER,
+    scope TEXT,
+    token_hash TEXT
+)'''
+LOGINS_COLUMN_NAMES = ("id", "timestamp", "service", "token_type", "expires_at", "scope", "token_hash")
+
+def _connect() -> sqlite3.Connection:
+    """
+    Open a connection to the analytics database with the tuned PRAGMAs applied.
+    """
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    conn.execute("PRAGMA optimize=0x10002")
+    return conn
+
+def _optimizer() -> None:
+    """
+    Periodically run PRAGMA optimize on the shared connection.
+    """
+    while True:
+        time.sleep(OPTIMIZE_INTERVAL)
+        with _CONN_LOCK:
+            if _CONN is None:
+                return
+            _CONN.execute("PRAGMA optimize")
+
+def _get_connection() -> sqlite3.Connection:
+    """
+    Return the shared connection, opening it on first use. Callers must hold _CONN_LOCK.
+    """
+    global _CONN
+    if _CONN is None:
+        _CONN = _connect()
+        threading.Thread(target=_optimizer, daemon=True).start()
+    return _CONN
+
+def _to_json(value) -> str:
+    """
+    Serialize a value compactly as JSON, falling back to str() for unsupported types.
+    """
+    return json.dumps(value, default=str, separators=(",", ":"))
+
+def _drain(q: queue.Queue, max_items: int, timeout: float) -> list:
+    """
+    Wait up to `timeout` seconds for an event, then take whatever else is queued (up to `max_items`).
+    """
+    try:
+        items = [q.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while len(items) < max_items:
+        try:
+            items.append(q.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+def _write_events(events: list) -> None:
+    """
+    Insert queued events, grouped by table, in a single transaction.
+    """
+    grouped = {}
+    for kind, row in events:
+        grouped.setdefault(kind, []).append(row)
+    with _CONN_LOCK:
+        conn = _get_connection()
+        with conn:
+            for kind, rows in grouped.items():
+                conn.executemany(INSERT_SQL[kind], rows)
+
+def _flusher() -> None:
+    """
+    Background loop that drains the event queue into the database.
+    """
+    while True:
+        events = _drain(_EVT_Q, FLUSH_MAX_EVENTS, FLUSH_INTERVAL)
+        if not events:
+            continue
+        try:
+            _write_events(events)
+        except sqlite3.Error as e:
+            print(f"Analytics flush error: {e}")
+
+def _flush_pending() -> None:
+    """
+    Write out anything still queued and close the connection; registered to run at interpreter exit.
+    """
+    events = _drain(_EVT_Q, _EVT_Q.maxsize, 0)
+    while events:
+        _write_events(events)
+        events = _drain(_EVT_Q, _EVT_Q.maxsize, 0)
+    with _CONN_LOCK:
+        if _CONN is not None:
+            _CONN.close()
+
+def _start_flusher() -> None:
+    """
+    Start the background flusher thread if it is not already running.
+    """
+    global _FLUSHER
+    with _FLUSHER_LOCK:
+        if _FLUSHER is None:
+            _FLUSHER = threading.Thread(target=_flusher, daemon=True)
+            _FLUSHER.start()
+            atexit.register(_flush_pending)
+
+def _enqueue(kind: str, row: tuple) -> None:
+    """
+    Queue an event for the flusher without blocking; events are dropped if the queue is full.
+    """
+    _start_flusher()
+    try:
+        _EVT_Q.put_nowait((kind, row))
+    except queue.Full:
+        print(f"Analytics queue full, dropping {kind} event")
+
 def init_analytics_db():
     """
     Initialize the analytics database with tables for logins and recommendations.
     """
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Create logins table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS logins (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT NOT NULL,
-            service TEXT NOT NULL,
-            token TEXT NOT NULL
-        )
-    ''')
-    
-    # Create recommendations table with language field
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS recommendations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT,
-            timestamp TEXT NOT NULL,
-            service TEXT NOT NULL,
-            playlist_id TEXT NOT NULL,
-            recommendation TEXT,
-            details TEXT,
-            language TEXT,
-            outcome TEXT DEFAULT 'success',
-            error_message TEXT
-        )
-    ''')
-    
-    # Check if language column exists, add it if not
-    try:
-        c.execute("SELECT language FROM recommendations LIMIT 1")
-    except sqlite3.OperationalError:
-        # Column doesn't exist, add it
-        c.execute("ALTER TABLE recommendations ADD COLUMN language TEXT")
-        
-    # Check if outcome column exists, add it if not
-    try:
-        c.execute("SELECT outcome FROM recommendations LIMIT 1")
-    except sqlite3.OperationalError:
-        # Column doesn't exist, add it
-        c.execute("ALTER TABLE recommendations ADD COLUMN outcome TEXT DEFAULT 'success'")
-        
-    # Check if error_message column exists, add it if not
-    try:
-        c.execute("SELECT error_message FROM recommendations LIMIT 1")
-    except sqlite3.OperationalError:
-        # Column doesn't exist, add it
-        c.execute("ALTER TABLE recommendations ADD COLUMN error_message TEXT")
-    
-    conn.commit()
-    conn.close()
+    with _CONN_LOCK:
+        _create_schema(_get_connection())
+    _start_flusher()
+
+def _create_schema(conn: sqlite3.Connection) -> None:
+    """
+    Create the analytics tables and add any columns missing from older databases.
+    """
+    with conn:
+        # Create logins table
+        conn.execute(f"CREATE TABLE IF NOT EXISTS logins {LOGINS_COLUMNS}")
+
+        # Older databases stored the full OAuth token; drop it and add the summary columns
+        login_cols = {row[1] for row in conn.execute("PRAGMA table_info(logins)")}
+        if "token" in login_cols:
+            if sqlite3.sqlite_version_info >= (3, 35, 0):
+                conn.execute("ALTER TABLE logins DROP COLUMN token")
+            else:
+                _rebuild_logins(conn, login_cols)
+                login_cols = {row[1] for row in conn.execute("PRAGMA table_info(logins)")}
+        for name, ddl in (
+            ("token_type", "TEXT"),
+            ("expires_at", "INTEGER"),
+            ("scope", "TEXT"),
+            ("token_hash", "TEXT"),
+        ):
+            if name not in login_cols:
+                conn.execute(f"ALTER TABLE logins ADD COLUMN {name} {ddl}")
+
+        # Create recommendations table with language field
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS recommendations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT,
+                timestamp TEXT NOT NULL,
+                service TEXT NOT NULL,
+                playlist_id TEXT NOT NULL,
+                recommendation TEXT,
+                details TEXT,
+                language TEXT,
+                outcome TEXT DEFAULT 'success',
+                error_message TEXT
+            )
+        ''')
+
+        # Add any columns missing from databases created before they were introduced
+        cols = {row[1] for row in conn.execute("PRAGMA table_info(recommendations)")}
+        for name, ddl in (
+            ("language", "TEXT"),
+            ("outcome", "TEXT DEFAULT 'success'"),
+            ("error_message", "TEXT"),
+        ):
+            if name not in cols:
+                conn.execute(f"ALTER TABLE recommendations ADD COLUMN {name} {ddl}")
+
+        # Indexes for per-session and per-service lookups; gather planner stats the first time
+        existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rec_session_ts ON recommendations(session_id, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_login_svc_ts ON logins(service, timestamp)")
+        if not {"idx_rec_session_ts", "idx_login_svc_ts"} <= existing:
+            conn.execute("ANALYZE")
+
+def _rebuild_logins(conn: sqlite3.Connection, login_cols: set) -> None:
+    """
+    Recreate the logins table without the legacy token column, for SQLite versions
+    older than 3.35 that lack ALTER TABLE ... DROP COLUMN.
+    """
+    keep = ", ".join(name for name in LOGINS_COLUMN_NAMES if name in login_cols)
+    conn.execute("DROP TABLE IF EXISTS logins_new")
+    conn.execute(f"CREATE TABLE logins_new {LOGINS_COLUMNS}")
+    conn.execute(f"INSERT INTO logins_new ({keep}) SELECT {keep} FROM logins")
+    conn.execute("DROP TABLE logins")
+    conn.execute("ALTER TABLE logins_new RENAME TO logins")
 
 def store_login_data(service: str, token: dict) -> None:
     """
-    Record a login event for the given service, storing the raw token info.
+    Queue a login event for the given service. Only non-sensitive token fields are kept,
+    plus a truncated SHA-256 of the access token for correlation.
     """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        'INSERT INTO logins (timestamp, service, token) VALUES (?, ?, ?)',
-        (datetime.utcnow().isoformat(), service, repr(token))
-    )
-    conn.commit()
-    conn.close()
+    # Spotify token_info uses access_token/scope; Google credentials use token/scopes
+    access_token = token.get('access_token') or token.get('token')
+    scope = token.get('scope') or ' '.join(token.get('scopes') or [])
+    token_hash = hashlib.sha256(access_token.encode()).hexdigest()[:16] if access_token else None
+    _enqueue('login', (
+        datetime.utcnow().isoformat(),
+        service,
+        token.get('token_type'),
+        token.get('expires_at'),
+        scope or None,
+        token_hash
+    ))
 
 def update_recommendation_data(
     session_id: str,
@@ -87,25 +277,16 @@ def update_recommendation_data(
     error_message: str = None
 ) -> None:
     """
-    Record a recommendation event, including session, playlist, output, and metadata.
-    """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        '''INSERT INTO recommendations
-           (session_id, timestamp, service, playlist_id, recommendation, details, language, outcome, error_message)
-           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-        (
-            session_id,
-            datetime.utcnow().isoformat(),
-            service,
-            playlist_id,
-            recommendation,
-            repr(details) if details else None,
-            language,
-            outcome,
-            error_message
-        )
-    )
-    conn.commit()
-    conn.close()
+    Queue a recommendation event, including session, playlist, output, and metadata.
+    """
+    _enqueue('rec', (
+        session_id,
+        datetime.utcnow().isoformat(),
+        service,
+        playlist_id,
+        recommendation,
+        _to_json(details) if details else None,
+        language,
+        outcome,
+        error_message
+    ))
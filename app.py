@@ -1,7 +1,10 @@
 from flask import Flask, render_template, request, session, jsonify, redirect, url_for
+from flask.json.provider import JSONProvider
 from flask_session import Session
+import orjson
 import os
 import secrets
+from functools import partial
 import html
 import re
 
@@ -19,14 +22,33 @@ from recommendation_service import process_playlist_and_recommend_song
 # Analytics
 from analytics import init_analytics_db, store_login_data, update_recommendation_data
 
+class OrjsonProvider(JSONProvider):
+    """
+    JSON provider backed by orjson, used by jsonify for API responses.
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 # Backfill the legacy session_cookie_name property so Flask-Session works on Flask 2.3+
 app.session_cookie_name = app.config.get('SESSION_COOKIE_NAME', 'session')
 
 # Secret and session config
 decimal_key = os.environ.get("SECRET_KEY") or secrets.token_hex(24)
 app.secret_key = decimal_key
-app.config["SESSION_TYPE"] = "filesystem"
+# Sessions are stored server-side; the cookie only carries the session id.
+# Use Redis when REDIS_URL is set so sessions are shared across instances.
+redis_url = os.environ.get("REDIS_URL")
+if redis_url:
+    import redis
+    app.config["SESSION_TYPE"] = "redis"
+    app.config["SESSION_REDIS"] = redis.from_url(redis_url)
+else:
+    app.config["SESSION_TYPE"] = "filesystem"
 app.config["SESSION_COOKIE_HTTPONLY"] = True
 app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
 
@@ -121,10 +143,17 @@ def api_recommendation():
         if not result or not result.get('recommendation'):
             return jsonify({'error': 'No recommendation returned.'}), 500
 
-        # Sanitize output
-        recommendation = html.escape(result['recommendation'])
+        recommendation = result['recommendation']
 
-        update_recommendation_data(
+        # Escape once for display; the frontend decodes entities before rendering
+        response = jsonify({
+            'recommendation': html.escape(recommendation),
+            'details': result.get('details', {})
+        })
+        # Record analytics after the response has been sent; arguments are bound
+        # now because the request context is gone by the time the callback runs
+        response.call_on_close(partial(
+            update_recommendation_data,
             session_id=session.get('entry_id'),
             service=service,
             playlist_id=playlist_id,
@@ -132,16 +161,15 @@ def api_recommendation():
             details=result.get('details', {}),
             language=language,
             outcome='success'
-        )
-
-        return jsonify({
-            'recommendation': recommendation,
-            'details': result.get('details', {})
-        })
+        ))
+        return response
 
     except Exception as e:
         app.logger.error(f"Recommendation error: {e}", exc_info=True)
-        update_recommendation_data(
+        response = jsonify({'error': 'Unexpected error occurred.'})
+        response.status_code = 500
+        response.call_on_close(partial(
+            update_recommendation_data,
             session_id=session.get('entry_id'),
             service=service,
             playlist_id=playlist_id,
@@ -150,8 +178,8 @@ def api_recommendation():
             language=language,
             outcome='failure',
             error_message=str(e)
-        )
-        return jsonify({'error': 'Unexpected error occurred.'}), 500
+        ))
+        return response
         
 if __name__ == '__main__':
     debug = os.environ.get('FLASK_ENV') == 'development'
@@ -3,27 +3,33 @@ recommendation_service.py
 
 Sophisticated music recommendation pipeline supporting Spotify and YouTube playlists.
 Includes feature extraction, prompt construction, multi-model querying,
-fuzzy duplicate filtering, cost estimation, YouTube link lookup,
-and analytics logging.
+fuzzy duplicate filtering, cost estimation and YouTube link lookup.
 """
+from __future__ import annotations
+
 import os
 import re
 import html
+import hashlib
 import logging
-from datetime import datetime
-from typing import Any, Dict, List, Tuple, Optional
-
-import pandas as pd
-import openai
-import requests
-from flask import session, current_app
-from googleapiclient.discovery import build
-from requests.adapters import HTTPAdapter, Retry
-from fuzzywuzzy import fuzz
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Deque, Dict, List, Tuple, Optional
+
+import httpx
+from flask import current_app
+from openai import OpenAI
 
 from spotify_service import SpotifyService
 from youtube_service import YouTubeService
-from analytics import update_recommendation_data
+
+# numpy, googleapiclient and rapidfuzz are imported where they are used
+# so that importing this module (and starting the app) stays cheap
 
 
 # ----------------------- Configuration -----------------------
@@ -31,36 +37,129 @@ OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY") or current_app.config.get("OPE
 YOUTUBE_API_KEY: str = os.getenv("YOUTUBE_API_KEY") or current_app.config.get("YOUTUBE_API_KEY")
 if not OPENAI_API_KEY or not YOUTUBE_API_KEY:
     raise RuntimeError("Missing OPENAI_API_KEY or YOUTUBE_API_KEY configuration.")
-openai.api_key = OPENAI_API_KEY
 
 MODELS_TO_TRY: List[str] = [os.getenv("OPENAI_MODEL", "gpt-4.1"), "gpt-3.5-turbo"]
 MODEL_PRICING: Dict[str, Dict[str, float]] = {
+    "gpt-4.1": {"input": 2.0, "output": 8.0},
     "gpt-4": {"input": 3.0, "output": 12.0},
     "gpt-3.5-turbo": {"input": 0.5, "output": 1.5},
 }
+MODEL_CONTEXT_TOKENS: Dict[str, int] = {
+    "gpt-4.1": 1047576,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+}
+COMPLETION_MAX_TOKENS: int = 150
+# tiktoken encoding per model; tiktoken 0.7 doesn't know gpt-4.1, which uses o200k_base
+MODEL_ENCODINGS: Dict[str, str] = {
+    "gpt-4.1": "o200k_base",
+    "gpt-4": "cl100k_base",
+    "gpt-3.5-turbo": "cl100k_base",
+}
+DEFAULT_ENCODING: str = "cl100k_base"
+# Prompts shorter than this go straight to the cheapest model (last in MODELS_TO_TRY)
+CHEAP_MODEL_PROMPT_TOKENS: int = int(os.getenv("CHEAP_MODEL_PROMPT_TOKENS", "2000"))
 MAX_ATTEMPTS: int = 3
+# Seconds to wait on a single completion before falling back to the next model
+MODEL_TIMEOUT: float = float(os.getenv("OPENAI_TIMEOUT", "8"))
+DUPLICATE_THRESHOLD: int = 85
+
+# Strips everything but lowercase alphanumerics before fuzzy title comparison
+_ALNUM_RE = re.compile(r"[^a-z0-9]")
+
+# Description batching for the LLM cleaner: a batch's estimated input must fit the
+# context window alongside the instructions and the reply, and since the reply is
+# roughly as long as the input it must also fit within max_tokens
+DESCRIPTION_CONTEXT_TOKENS: int = 16384
+DESCRIPTION_MAX_TOKENS: int = 4000
+DESCRIPTION_INSTRUCTION_TOKENS: int = 500
+DESCRIPTION_MARKER_TOKENS: int = 8
+DESCRIPTION_WORKERS: int = 4
+DESCRIPTION_BATCH_TOKENS: int = min(
+    DESCRIPTION_CONTEXT_TOKENS - DESCRIPTION_MAX_TOKENS - DESCRIPTION_INSTRUCTION_TOKENS,
+    DESCRIPTION_MAX_TOKENS,
+)
+
+# Cleaned descriptions keyed by a hash of their (truncated) text, so copy-pasted
+# promo blocks are only sent to the LLM once; oldest entries are evicted first
+DESCRIPTION_CACHE_MAX: int = 4096
+_DESC_CACHE: Dict[bytes, str] = {}
+_DESC_CACHE_LOCK = threading.Lock()
+
+# Description cleaning patterns (see _transform_description_regex)
+_RE_URL = re.compile(r'https?://\S+')
+_RE_PROMO = re.compile(
+    r'follow (me|us) on (twitter|facebook|instagram|tiktok|youtube).*?[\n\r]'
+    r'|(twitter|facebook|instagram|tiktok):\s*@[\w\._]+'
+    r'|(subscribe|like|comment|share|hit the bell).*?[\n\r]'
+    r'|©.*?(\d{4}).*?[\n\r]'
+    r'|(available now|buy now|stream on|check out|official video|official audio).*?[\n\r]',
+    re.IGNORECASE,
+)
+_RE_TIMESTAMP = re.compile(r'\d+:\d+(\:\d+)?(\s+[-–—]\s+.*?)?[\n\r]')
+_RE_BLANK_LINES = re.compile(r'[\n\r]{3,}')
+# Leftovers after regex cleaning that justify an LLM pass: link fragments, handles,
+# or promotional keywords that did not sit on their own line
+_RE_SUSPICIOUS = re.compile(
+    r'www\.|\.com\b|@\w{3,}|\b(merch|discount|promo code|pre-?order|tickets|patreon)\b',
+    re.IGNORECASE,
+)
+
+# Spotify audio features included in the prompt, with their display format
+AUDIO_FEATURES: Dict[str, str] = {
+    "danceability": "danceability={:.2f}",
+    "energy": "energy={:.2f}",
+    "tempo": "tempo={:.1f}",
+    "valence": "valence={:.2f}",
+}
 
-# HTTP session with retry strategy
-HTTP_SESSION = requests.Session()
-HTTP_SESSION.mount(
-    "https://",
-    HTTPAdapter(
-        max_retries=Retry(total=5, backoff_factor=1.0, status_forcelist=[429, 500, 502, 503, 504])
+# Shared HTTP/2 client; one pooled connection per host is multiplexed across threads
+HTTP_CLIENT = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        retries=5,
     ),
 )
 
+# Single OpenAI client reused by every completion, on top of the shared pool
+OPENAI_CLIENT = OpenAI(api_key=OPENAI_API_KEY, max_retries=3, timeout=60, http_client=HTTP_CLIENT)
+# Recommendation queries must fail within MODEL_TIMEOUT so the fallback model can answer,
+# so they are never retried by the SDK (description cleaning keeps the retrying client).
+# For streams this timeout only bounds each read; _query_model enforces the total.
+RECOMMENDATION_CLIENT = OPENAI_CLIENT.with_options(max_retries=0, timeout=MODEL_TIMEOUT)
+
+# Cached YouTube search clients (see _youtube_search_client)
+_YT_LOCAL = threading.local()
+
 # Logger setup
 log = logging.getLogger(__name__)
-LOG_BUFFER: List[str] = []
+# Per-request log buffer of (time_ns, message); set at the start of
+# process_playlist_and_recommend_song and formatted only when returned
+LOG_BUFFER_MAX: int = 10000
+_LOG_BUF: ContextVar[Deque[Tuple[int, str]]] = ContextVar("log_buf")
+
+# tiktoken encodings by name, filled by _load_encoders; until (or unless) an encoding
+# is loaded, _count_tokens estimates from text length instead
+_ENCODERS: Dict[str, Any] = {}
 
 
 # ------------------------- Helpers ---------------------------
 def _log(message: str) -> None:
-    """Add timestamped entry to buffer and application log."""
-    timestamp = datetime.utcnow().isoformat()
-    entry = f"[{timestamp}] {message}"
-    LOG_BUFFER.append(entry)
-    log.debug(entry)
+    """Add timestamped entry to the current request's buffer and application log."""
+    buf = _LOG_BUF.get(None)
+    if buf is not None:
+        buf.append((time.time_ns(), message))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(message)
+
+
+def _format_logs(buf: Deque[Tuple[int, str]]) -> List[str]:
+    """Render buffered log entries as "[utc-iso-timestamp] message" strings."""
+    return [
+        f"[{datetime.fromtimestamp(ts / 1e9, timezone.utc).replace(tzinfo=None).isoformat()}] {message}"
+        for ts, message in buf
+    ]
 
 
 def _calculate_cost(usage: Dict[str, int], model: str) -> float:
@@ -71,6 +170,54 @@ def _calculate_cost(usage: Dict[str, int], model: str) -> float:
     return cost_in + cost_out
 
 
+def _load_encoders() -> None:
+    """
+    Load the tiktoken encodings once, off the request path: tiktoken downloads its
+    BPE files on first use without a timeout. Encodings that fail to load are skipped.
+    """
+    try:
+        import tiktoken
+    except ImportError as exc:
+        log.warning("tiktoken unavailable (%s), token counts will be estimated", exc)
+        return
+    for name in {*MODEL_ENCODINGS.values(), DEFAULT_ENCODING}:
+        try:
+            _ENCODERS[name] = tiktoken.get_encoding(name)
+        except Exception as exc:
+            log.warning("Could not load tiktoken encoding %s (%s), token counts will be estimated", name, exc)
+
+
+def _count_tokens(text: str, model: str) -> int:
+    """Count tokens with the model's tiktoken encoding, or ~4 characters per token if it isn't loaded."""
+    encoder = _ENCODERS.get(MODEL_ENCODINGS.get(model, DEFAULT_ENCODING))
+    if encoder is None:
+        _log(f"No tokenizer loaded for {model}, estimating tokens from length")
+        return len(text) // 4
+    return len(encoder.encode(text))
+
+
+threading.Thread(target=_load_encoders, name="tiktoken-loader", daemon=True).start()
+
+
+def _estimate_cost(prompt_tokens: int, model: str) -> float:
+    """Upper-bound cost ($) of one completion before it is issued."""
+    return _calculate_cost({"prompt_tokens": prompt_tokens, "completion_tokens": COMPLETION_MAX_TOKENS}, model)
+
+
+def _select_models(prompt_tokens: int) -> List[str]:
+    """
+    Pick the models to try for a prompt of the given size: skip models whose context
+    cannot hold it, and use only the cheapest model when the prompt is short.
+    """
+    models = [
+        m for m in MODELS_TO_TRY
+        if prompt_tokens + COMPLETION_MAX_TOKENS <= MODEL_CONTEXT_TOKENS.get(m, float("inf"))
+    ]
+    if models and prompt_tokens < CHEAP_MODEL_PROMPT_TOKENS:
+        return models[-1:]
+    return models
+
+
 def _transform_description_regex(description: str) -> str:
     """
     Filter a YouTube description using regex patterns as a fallback method.
@@ -79,38 +226,116 @@ def _transform_description_regex(description: str) -> str:
         return ""
     
     # Remove URLs
-    cleaned = re.sub(r'https?://\S+', '', description)
+    cleaned = _RE_URL.sub('', description)
     
-    # Remove common social media patterns
-    cleaned = re.sub(r'(?i)follow (me|us) on (twitter|facebook|instagram|tiktok|youtube).*?[\n\r]', '', cleaned)
-    cleaned = re.sub(r'(?i)(twitter|facebook|instagram|tiktok):\s*@[\w\._]+', '', cleaned)
-    
-    # Remove subscription requests
-    cleaned = re.sub(r'(?i)(subscribe|like|comment|share|hit the bell).*?[\n\r]', '', cleaned)
+    # Remove social media mentions, subscription requests, copyright notices
+    # and promotional phrases in one pass
+    cleaned = _RE_PROMO.sub('', cleaned)
     
     # Remove timestamps (e.g., 0:00, 1:23, 01:45)
-    cleaned = re.sub(r'\d+:\d+(\:\d+)?(\s+[-–—]\s+.*?)?[\n\r]', '', cleaned)
-    
-    # Remove copyright notices
-    cleaned = re.sub(r'(?i)©.*?(\d{4}).*?[\n\r]', '', cleaned)
-    
-    # Remove common promotional phrases
-    cleaned = re.sub(r'(?i)(available now|buy now|stream on|check out|official video|official audio).*?[\n\r]', '', cleaned)
+    cleaned = _RE_TIMESTAMP.sub('', cleaned)
     
     # Handle multiple consecutive line breaks
-    cleaned = re.sub(r'[\n\r]{3,}', '\n\n', cleaned)
+    cleaned = _RE_BLANK_LINES.sub('\n\n', cleaned)
     
     # Trim and return
     return cleaned.strip()
 
 
-def _batch_transform_descriptions(descriptions: List[str], batch_size: int = 50) -> List[str]:
+def _estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) plus the per-description marker overhead."""
+    return len(text) // 4 + DESCRIPTION_MARKER_TOKENS
+
+
+def _description_key(text: str) -> bytes:
+    """Content hash used as the description cache key."""
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+def _cache_descriptions(batch: List[str], cleaned: List[str]) -> None:
+    """Remember LLM-cleaned descriptions, evicting the oldest entries past DESCRIPTION_CACHE_MAX."""
+    with _DESC_CACHE_LOCK:
+        for desc, clean in zip(batch, cleaned):
+            _DESC_CACHE[_description_key(desc)] = clean
+        while len(_DESC_CACHE) > DESCRIPTION_CACHE_MAX:
+            del _DESC_CACHE[next(iter(_DESC_CACHE))]
+
+
+def _pack_description_batches(indices: List[int], texts: List[str], token_budget: int) -> List[List[int]]:
+    """Greedily group description indices so each group's estimated tokens stay within budget."""
+    batches: List[List[int]] = []
+    current: List[int] = []
+    used = 0
+    for idx in indices:
+        cost = _estimate_tokens(texts[idx])
+        if current and used + cost > token_budget:
+            batches.append(current)
+            current, used = [], 0
+        current.append(idx)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _clean_description_batch(batch: List[str]) -> List[str]:
+    """Clean one batch of non-empty descriptions with OpenAI, falling back to regex on failure."""
+    # Create a combined prompt
+    prompt = f"""
+    For each YouTube video description below, remove ONLY the following elements:
+    - URLs and links
+    - Social media mentions
+    - Subscription/like/comment requests
+    - Timestamps (0:00, 1:23, etc.)
+    - Copyright notices
+    - Marketing language
+    - Merch promotions
+    
+    Return ONLY cleaned descriptions, with one description per line, separated by the marker [DESC_END].
+    Preserve all other content exactly as is.
+    
+    DESCRIPTIONS:
+    """ + "\n[DESC_START]\n".join(batch) + "\n[DESC_END]"
+    
+    try:
+        _log(f"Sending batch of {len(batch)} descriptions to OpenAI")
+        response = OPENAI_CLIENT.chat.completions.create(
+            model="gpt-3.5-turbo",  # U
+            messages=[
+                {"role": "system", "content": "You clean YouTube descriptions by removing specified elements."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.3,
+            max_tokens=DESCRIPTION_MAX_TOKENS
+        )
+        result = response.choices[0].message.content.strip()
+        
+        # Split the results back into individual descriptions
+        cleaned_batch = result.split("[DESC_END]")
+        cleaned_batch = [desc.strip() for desc in cleaned_batch if desc.strip()]
+        _log(f"Successfully cleaned batch of {len(batch)} descriptions")
+        # Only cache when the reply lines up one-to-one with the inputs
+        if len(cleaned_batch) == len(batch):
+            _cache_descriptions(batch, cleaned_batch)
+        return cleaned_batch
+        
+    except Exception as e:
+        _log(f"Error in batch transformation: {e}, falling back to regex cleaning")
+        # Fall back to regex-based cleaning if API fails
+        return [_transform_description_regex(desc) for desc in batch]
+
+
+def _batch_transform_descriptions(
+    descriptions: List[str], token_budget: int = DESCRIPTION_BATCH_TOKENS
+) -> List[str]:
     """
     Transform multiple YouTube descriptions in batches using the OpenAI API.
+    Up to DESCRIPTION_WORKERS batches are in flight at once. Descriptions already
+    in the cache, or repeated within the call, are not sent again.
     
     Args:
         descriptions: List of YouTube descriptions to clean
-        batch_size: Number of descriptions to process in a single API call
+        token_budget: Estimated description tokens to pack into a single API call
         
     Returns:
         List of cleaned descriptions in the same order
@@ -119,190 +344,162 @@ def _batch_transform_descriptions(descriptions: List[str], batch_size: int = 50)
         return []
     
     _log(f"Batch transforming {len(descriptions)} descriptions")
-    cleaned_descriptions = []
     
-    # Process descriptions in batches
-    for i in range(0, len(descriptions), batch_size):
-        batch = descriptions[i:i+batch_size]
-        
-        # Skip empty descriptions
-        batch = [desc if desc and desc.strip() else "" for desc in batch]
-        non_empty_indices = [idx for idx, desc in enumerate(batch) if desc]
-        
-        if not non_empty_indices:
-            cleaned_descriptions.extend([""] * len(batch))
+    # Skip empty descriptions and limit length to save tokens
+    texts = [desc[:500] if desc and desc.strip() else "" for desc in descriptions]
+    cleaned_descriptions = [""] * len(texts)
+    
+    # Fill cache hits and group the remaining indices by content
+    pending: Dict[bytes, List[int]] = {}
+    keys: Dict[int, bytes] = {}
+    for idx, desc in enumerate(texts):
+        if not desc:
             continue
-            
-        # Limit description length to save tokens
-        batch = [desc[:500] if len(desc) > 500 else desc for desc in batch if desc]
-        
-        # Create a combined prompt
-        prompt = f"""
-        For each YouTube video description below, remove ONLY the following elements:
-        - URLs and links
-        - Social media mentions
-        - Subscription/like/comment requests
-        - Timestamps (0:00, 1:23, etc.)
-        - Copyright notices
-        - Marketing language
-        - Merch promotions
-        
-        Return ONLY cleaned descriptions, with one description per line, separated by the marker [DESC_END].
-        Preserve all other content exactly as is.
-        
-        DESCRIPTIONS:
-        """ + "\n[DESC_START]\n".join(batch) + "\n[DESC_END]"
-        
-        try:
-            _log(f"Sending batch of {len(batch)} descriptions to OpenAI")
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",  # U
-                messages=[
-                    {"role": "system", "content": "You clean YouTube descriptions by removing specified elements."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.3,
-                max_tokens=4000
-            )
-            result = response.choices[0].message.content.strip()
-            
-            # Split the results back into individual descriptions
-            cleaned_batch = result.split("[DESC_END]")
-            cleaned_batch = [desc.strip() for desc in cleaned_batch if desc.strip()]
-            
-            # Reintegrate with empty descriptions
-            full_cleaned_batch = [""] * len(batch)
-            for idx, clean_desc in zip(non_empty_indices, cleaned_batch):
-                full_cleaned_batch[idx] = clean_desc
-                
-            cleaned_descriptions.extend(full_cleaned_batch)
-            _log(f"Successfully cleaned batch of {len(batch)} descriptions")
-            
-        except Exception as e:
-            _log(f"Error in batch transformation: {e}, falling back to regex cleaning")
-            # Fall back to regex-based cleaning if API fails
-            cleaned_batch = []
-            for desc in batch:
-                if not desc:
-                    cleaned_batch.append("")
-                    continue
-                cleaned_batch.append(_transform_description_regex(desc))
-                
-            cleaned_descriptions.extend(cleaned_batch)
+        key = _description_key(desc)
+        hit = _DESC_CACHE.get(key)
+        if hit is not None:
+            cleaned_descriptions[idx] = hit
+        else:
+            keys[idx] = key
+            pending.setdefault(key, []).append(idx)
+    unique_indices = [indices[0] for indices in pending.values()]
+    if len(unique_indices) < len(texts):
+        _log(f"{len(unique_indices)} unique uncached descriptions to clean")
+    
+    # Process descriptions in batches sized by estimated tokens rather than count
+    batches = _pack_description_batches(unique_indices, texts, token_budget)
+    if not batches:
+        return cleaned_descriptions
+    with ThreadPoolExecutor(max_workers=min(DESCRIPTION_WORKERS, len(batches))) as pool:
+        futures = [
+            pool.submit(copy_context().run, _clean_description_batch, [texts[idx] for idx in batch_indices])
+            for batch_indices in batches
+        ]
+        # Reintegrate with empty descriptions
+        for batch_indices, future in zip(batches, futures):
+            for idx, clean_desc in zip(batch_indices, future.result()):
+                for dup in pending[keys[idx]]:
+                    cleaned_descriptions[dup] = clean_desc
             
     return cleaned_descriptions
 
 
-def _fetch_spotify_dataframe(playlist_id: str, client: Any) -> pd.DataFrame:
-    """Retrieve Spotify tracks and features as a DataFrame."""
+def _clean_descriptions(descriptions: List[str], use_llm: bool = False) -> List[str]:
+    """
+    Clean descriptions with the regex filter. When `use_llm` is set, only descriptions
+    whose regex output still looks promotional are re-cleaned through the OpenAI batch path.
+    """
+    cleaned = [_transform_description_regex(desc) for desc in descriptions]
+    if not use_llm:
+        return cleaned
+
+    suspicious = [idx for idx, desc in enumerate(cleaned) if _RE_SUSPICIOUS.search(desc)]
+    if suspicious:
+        _log(f"Regex cleaning left {len(suspicious)} suspicious descriptions, sending to OpenAI")
+        llm_cleaned = _batch_transform_descriptions([descriptions[idx] for idx in suspicious])
+        for idx, desc in zip(suspicious, llm_cleaned):
+            cleaned[idx] = desc
+    return cleaned
+
+
+def _fetch_spotify_records(playlist_id: str, client: Any) -> List[Dict[str, Any]]:
+    """Retrieve Spotify tracks merged with their audio features as a list of dicts."""
     svc = SpotifyService(client)
     tracks = svc.get_playlist_tracks(playlist_id)
     if not tracks:
-        return pd.DataFrame()
+        return []
 
-    df_feats = pd.DataFrame(svc.get_audio_features([t["id"] for t in tracks]))
-    df_meta = pd.DataFrame(
-        [{"id": t["id"], "name": t["name"], "artist": t["artists"][0] if t["artists"] else "", "album": t.get("album", "")} for t in tracks]
-    )
-    return df_meta.merge(df_feats, on="id", how="inner")
+    feats_by_id = {f["id"]: f for f in svc.get_audio_features([t["id"] for t in tracks])}
+    # Tracks without audio features are dropped
+    return [
+        {
+            "id": t["id"],
+            "name": t["name"],
+            "artist": t["artists"][0] if t["artists"] else "",
+            "album": t.get("album", ""),
+            **{col: feats_by_id[t["id"]].get(col) for col in AUDIO_FEATURES},
+        }
+        for t in tracks
+        if t["id"] in feats_by_id
+    ]
 
 
-def _fetch_youtube_dataframe(playlist_id: str, client: Any) -> pd.DataFrame:
-    """Retrieve YouTube playlist items with enhanced metadata as a DataFrame."""
+def _fetch_youtube_records(playlist_id: str, client: Any) -> List[Dict[str, Any]]:
+    """Retrieve YouTube playlist items with enhanced metadata as a list of dicts."""
     svc = YouTubeService(client)
     videos = svc.get_playlist_items(playlist_id)
     if not videos:
-        return pd.DataFrame()
+        return []
 
     # Collect all descriptions for batch processing
     _log(f"Retrieved {len(videos)} videos from playlist")
     all_descriptions = [video.get('description', '') for video in videos]
     
-    # Transform descriptions in batches
+    # Clean descriptions (regex by default; pass use_llm=True to re-clean leftovers with OpenAI)
     _log(f"Processing {len(all_descriptions)} video descriptions in batches")
-    #transformed_descriptions = _batch_transform_descriptions(all_descriptions)
+    #transformed_descriptions = _clean_descriptions(all_descriptions)
     
     # Process videos to add transformed descriptions
-    enhanced_videos = []
-    for i, video in enumerate(videos):
-        enhanced_video = {
+    return [
+        {
             "id": video["id"],
             "name": video["name"],
             "artist": video.get("channel", ""),
             "album": "",
             "published_at": video.get("published_at", ""),
             "description": video.get("description", ""),
-            
             #"transformed_description": transformed_descriptions[i] if i < len(transformed_descriptions) else "",
             "tags": video.get("tags", []),
             "topic_categories": video.get("topic_categories", [])
         }
-        enhanced_videos.append(enhanced_video)
-    
-    return pd.DataFrame(enhanced_videos)
-
+        for video in videos
+    ]
 
-def _construct_prompt(df: pd.DataFrame, language: str) -> Tuple[str, List[str]]:
-    """Build LLM prompt lines and exclusion list from sample songs."""
-    sample_size = min(len(df), 200)
-    sample = df.sample(sample_size, random_state=42)
 
+def _spotify_prompt_lines(records: List[Dict[str, Any]]) -> Tuple[List[str], List[str]]:
+    """Format prompt lines and lowercase titles for Spotify tracks (album, audio features)."""
     lines, exclusions = [], []
-    for _, row in sample.iterrows():
-        # Basic track info
-        track_info = f"'{row['name']}' by {row['artist']}"
-        
-        # Add additional context based on available fields
+    for rec in records:
         extra_info = []
-        
-        # Add album if available (mainly for Spotify)
-        if 'album' in row and row['album']:
-            extra_info.append(f"Album: {row['album']}")
-            
-        # Add tags if available (mainly for YouTube)
-        if 'tags' in row and isinstance(row['tags'], list) and row['tags']:
-            # Limit to first 5 tags to keep prompt reasonable
-            tag_str = ', '.join(row['tags'][:5])
-            extra_info.append(f"Tags: {tag_str}")
-            
-        # Add topic categories if available (YouTube)
-        if 'topic_categories' in row and isinstance(row['topic_categories'], list) and row['topic_categories']:
-            topic_str = ', '.join(row['topic_categories'][:3])
-            extra_info.append(f"Topics: {topic_str}")
-            
-        # Add publication date if available (YouTube)
-        if 'published_at' in row and row['published_at']:
-            pub_date = row['published_at'].split('T')[0] if 'T' in row['published_at'] else row['published_at']
-            extra_info.append(f"Published: {pub_date}")
-            
-        # Add transformed description if available and not empty (YouTube)
-        '''
-        if 'transformed_description' in row and row['transformed_description'] and row['transformed_description'] != "No relevant information.":
-            desc = row['transformed_description']
-            # Keep description brief in the prompt
-            if len(desc) > 100:
-                desc = desc[:97] + "..."
-            extra_info.append(f"Context: {desc}")
-        '''
-        desc=row['description']
-            
-        # Add audio features if available (Spotify)
-        feats = []
-        for col in ["danceability", "energy", "tempo", "valence"]:
-            if col in row and not pd.isna(row[col]):
-                val = float(row[col])
-                feats.append(f"{col}={val:.2f}" if col != "tempo" else f"tempo={val:.1f}")
+        if rec["album"]:
+            extra_info.append(f"Album: {rec['album']}")
+        feats = [fmt.format(rec[col]) for col, fmt in AUDIO_FEATURES.items() if rec[col] is not None]
         if feats:
             extra_info.append(f"Features: {', '.join(feats)}")
-            
-        # Combine all information
-        if extra_info:
-            lines.append(f"- {track_info} [{' | '.join(extra_info)}]")
-        else:
-            lines.append(f"- {track_info}")
-            
-        # Add to exclusion list
-        exclusions.append(row['name'].lower())
+
+        track_info = f"'{rec['name']}' by {rec['artist']}"
+        lines.append(f"- {track_info} [{' | '.join(extra_info)}]" if extra_info else f"- {track_info}")
+        exclusions.append(rec["name"].lower())
+    return lines, exclusions
+
+
+def _youtube_prompt_lines(records: List[Dict[str, Any]]) -> Tuple[List[str], List[str]]:
+    """Format prompt lines and lowercase titles for YouTube videos (tags, topics, publish date)."""
+    lines, exclusions = [], []
+    for rec in records:
+        extra_info = []
+        # Limit tags and topics to keep prompt reasonable
+        if rec["tags"]:
+            extra_info.append(f"Tags: {', '.join(rec['tags'][:5])}")
+        if rec["topic_categories"]:
+            extra_info.append(f"Topics: {', '.join(rec['topic_categories'][:3])}")
+        if rec["published_at"]:
+            extra_info.append(f"Published: {rec['published_at'].split('T')[0]}")
+
+        track_info = f"'{rec['name']}' by {rec['artist']}"
+        lines.append(f"- {track_info} [{' | '.join(extra_info)}]" if extra_info else f"- {track_info}")
+        exclusions.append(rec["name"].lower())
+    return lines, exclusions
+
+
+def _construct_prompt(data: List[Dict[str, Any]], language: str, service: str) -> Tuple[str, List[str]]:
+    """Build LLM prompt lines and the cleaned exclusion list used for duplicate checks."""
+    import numpy as np
+
+    sample_size = min(len(data), 200)
+    idx = np.random.default_rng(42).choice(len(data), size=sample_size, replace=False)
+    format_lines = _spotify_prompt_lines if service == "spotify" else _youtube_prompt_lines
+    lines, exclusions = format_lines([data[i] for i in idx])
 
     prompt = (
         f"You are a music curator. Analyze these songs and recommend one new song not listed, in {html.escape(language)}.\n\n"
@@ -310,37 +507,171 @@ def _construct_prompt(df: pd.DataFrame, language: str) -> Tuple[str, List[str]]:
         + "\n\nExclude: " + ", ".join(f'"{s}"' for s in exclusions)
         + "\nProvide ONLY: Title - Artist - Album"
     )
-    return prompt, exclusions
+    cleaned_exclusions = [_ALNUM_RE.sub("", ex) for ex in exclusions]
+    return prompt, cleaned_exclusions
 
 
-def _query_model(prompt: str, exclusion: List[str], model: str) -> Tuple[str, Dict[str, Any]]:
-    """Attempt multiple times to get a non-duplicate recommendation from given model."""
+def _recommended_title(rec: str) -> str:
+    """Lowercase title from a 'Title - Artist - Album' recommendation."""
+    return rec.split(" - ")[0].strip().lower().strip('"')
+
+
+def _is_duplicate(title: str, cleaned_exclusions: List[str], exclusion_set: frozenset) -> bool:
+    """Whether a title exactly or fuzzily matches any sampled playlist title."""
+    clean_title = _ALNUM_RE.sub("", title)
+    # Exact repeats of a sampled title are the common case; skip the fuzzy scan for them
+    if clean_title in exclusion_set:
+        return True
+
+    from rapidfuzz import fuzz, process
+
+    return process.extractOne(
+        clean_title, cleaned_exclusions, scorer=fuzz.ratio, score_cutoff=DUPLICATE_THRESHOLD
+    ) is not None
+
+
+def _query_model(
+    prompt: str,
+    prompt_tokens: int,
+    cleaned_exclusions: List[str],
+    model: str,
+    stop: Optional[threading.Event] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Attempt multiple times to get a non-duplicate recommendation from given model.
+    Responses are streamed so a duplicate title can be rejected as soon as it is complete.
+    Setting `stop` closes the current stream and abandons any remaining attempts.
+    """
+    exclusion_set = frozenset(cleaned_exclusions)
     for attempt in range(1, MAX_ATTEMPTS + 1):
+        if stop is not None and stop.is_set():
+            break
         temp = 0.6 + 0.1 * attempt
         _log(f"Querying {model}, attempt {attempt}, temperature={temp}")
-        resp = openai.ChatCompletion.create(
+        deadline = time.monotonic() + MODEL_TIMEOUT
+        stream = RECOMMENDATION_CLIENT.chat.completions.create(
             model=model,
             messages=[
                 {"role": "system", "content": "You are a refined music recommendation assistant."},
                 {"role": "user", "content": prompt},
             ],
             temperature=temp,
-            max_tokens=150,
+            max_tokens=COMPLETION_MAX_TOKENS,
+            stream=True,
+            stream_options={"include_usage": True},
         )
-        rec = resp.choices[0].message.content.strip()
-        title = rec.split(" - ")[0].strip().lower().strip('"')
-        clean_title = re.sub(r"[^a-z0-9]", "", title)
-        if any(fuzz.ratio(clean_title, re.sub(r"[^a-z0-9]", "", ex)) > 85 for ex in exclusion):
+        content, title, duplicate, usage = "", None, False, None
+        for chunk in stream:
+            if stop is not None and stop.is_set():
+                stream.close()
+                break
+            if time.monotonic() > deadline:
+                stream.close()
+                raise TimeoutError(f"{model} did not finish within {MODEL_TIMEOUT}s")
+            # The final chunk carries the usage and no choices
+            if chunk.usage is not None:
+                usage = {
+                    "prompt_tokens": chunk.usage.prompt_tokens,
+                    "completion_tokens": chunk.usage.completion_tokens,
+                }
+            if not chunk.choices:
+                continue
+            content += chunk.choices[0].delta.content or ""
+            # The title is complete once the first separator arrives
+            if title is None and " - " in content:
+                title = _recommended_title(content)
+                duplicate = _is_duplicate(title, cleaned_exclusions, exclusion_set)
+                if duplicate:
+                    stream.close()
+                    break
+        if stop is not None and stop.is_set():
+            break
+        rec = content.strip()
+        if title is None:
+            title = _recommended_title(rec)
+            duplicate = _is_duplicate(title, cleaned_exclusions, exclusion_set)
+        if duplicate:
             _log(f"Duplicate detected ({title}), retrying...")
             continue
-        usage = {"prompt_tokens": resp.usage.prompt_tokens, "completion_tokens": resp.usage.completion_tokens}
+        if usage is None:
+            _log(f"{model} reported no usage, counting tokens locally")
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": _count_tokens(rec, model)}
         return rec, {"usage": usage, "model": model}
+    if stop is not None and stop.is_set():
+        raise RuntimeError(f"Stopped querying {model}, another model answered first")
     raise RuntimeError(f"No unique recommendation after {MAX_ATTEMPTS} attempts with {model}")
 
 
+def _query_model_logged(entries: List[Tuple[int, str]], *args: Any) -> Tuple[str, Dict[str, Any]]:
+    """Run _query_model with _log writing to `entries` instead of the request buffer."""
+    _LOG_BUF.set(entries)
+    return _query_model(*args)
+
+
+def _query_models_concurrently(
+    prompt: str, prompt_tokens: int, cleaned_exclusions: List[str], models: List[str]
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Query all models at once and return the result of the most preferred model that
+    succeeds, so a failing primary model adds no latency before the fallback.
+    Each query logs to its own list; only finished queries are merged into the
+    request's buffer, and the rest are told to stop once a result is chosen.
+    """
+    if not models:
+        raise RuntimeError("No model can accept this prompt.")
+    stop = threading.Event()
+    model_logs: List[List[Tuple[int, str]]] = [[] for _ in models]
+    buf = _LOG_BUF.get(None)
+    pool = ThreadPoolExecutor(max_workers=len(models))
+    try:
+        # Run each query in a copy of this context so its log list stays private to it
+        futures = [
+            pool.submit(
+                copy_context().run, _query_model_logged, entries,
+                prompt, prompt_tokens, cleaned_exclusions, model, stop,
+            )
+            for model, entries in zip(models, model_logs)
+        ]
+        for future, entries in zip(futures, model_logs):
+            try:
+                result = future.result()
+            except Exception as exc:
+                if buf is not None:
+                    buf.extend(entries)
+                _log(str(exc))
+                continue
+            if buf is not None:
+                buf.extend(entries)
+            return result
+    finally:
+        # Stop slower, less preferred models once we have an answer (or none is left)
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+    raise RuntimeError("No model returned a unique recommendation.")
+
+
+def _youtube_search_client() -> Any:
+    """
+    Return this thread's API-key YouTube client, building it on first use.
+    The underlying httplib2 transport is not thread-safe, so clients are per thread.
+    """
+    yt = getattr(_YT_LOCAL, "client", None)
+    if yt is None:
+        from googleapiclient.discovery import build
+        yt = build("youtube", "v3", developerKey=YOUTUBE_API_KEY, cache_discovery=False, static_discovery=True)
+        _YT_LOCAL.client = yt
+    return yt
+
+
 def _search_youtube_video(query: str) -> Optional[Dict[str, Any]]:
-    """Find top YouTube video matching query."""
-    yt = build("youtube", "v3", developerKey=YOUTUBE_API_KEY)
+    """Find top YouTube video matching query; results are cached per normalized query."""
+    return _cached_youtube_search(" ".join(query.lower().split()))
+
+
+@lru_cache(maxsize=4096)
+def _cached_youtube_search(query: str) -> Optional[Dict[str, Any]]:
+    """Uncached YouTube search behind _search_youtube_video."""
+    yt = _youtube_search_client()
     resp = yt.search().list(part="snippet", q=query, maxResults=1, type="video").execute()
     items = resp.get("items", [])
     if not items:
@@ -363,50 +694,49 @@ def process_playlist_and_recommend_song(
     language: str = "english",
 ) -> Dict[str, Any]:
     """
-    Core pipeline: fetch data, build prompt, query models, assemble result, send analytics.
+    Core pipeline: fetch data, build prompt, query models, assemble result.
+    The recommendation is returned unescaped; analytics are recorded by the caller.
     """
-    LOG_BUFFER.clear()
-    df = (
-        _fetch_spotify_dataframe(playlist_id, client)
+    logs: Deque[Tuple[int, str]] = deque(maxlen=LOG_BUFFER_MAX)
+    _LOG_BUF.set(logs)
+    data = (
+        _fetch_spotify_records(playlist_id, client)
         if service == "spotify"
-        else _fetch_youtube_dataframe(playlist_id, client)
+        else _fetch_youtube_records(playlist_id, client)
     )
-    if df.empty:
+    if len(data) == 0:
         error = "Playlist data unavailable or empty."
         _log(error)
-        return {"recommendation": None, "details": {"error": error, "logs": LOG_BUFFER}}
+        return {"recommendation": None, "details": {"error": error, "logs": _format_logs(logs)}}
 
-    prompt, exclusions = _construct_prompt(df, language)
+    prompt, exclusions = _construct_prompt(data, language, service)
     recommendation, details = None, {}
 
-    for model in MODELS_TO_TRY:
-        try:
-            rec_text, meta = _query_model(prompt, exclusions, model)
-            cost = _calculate_cost(meta["usage"], meta["model"])
-            _log(f"Success with {meta['model']}, cost=${cost:.6f}")
-            yt_info = _search_youtube_video(rec_text)
-            details = {"model": meta["model"], "cost_usd": cost, "youtube": yt_info, "logs": LOG_BUFFER.copy()}
-            recommendation = rec_text
-            break
-        except Exception as exc:
-            _log(str(exc))
+    # Count prompt tokens locally to choose models and estimate cost up front
+    prompt_tokens = _count_tokens(prompt, MODELS_TO_TRY[0])
+    models = _select_models(prompt_tokens)
+    _log(f"Prompt is ~{prompt_tokens} tokens, trying {', '.join(models) or 'no models'}")
+
+    try:
+        rec_text, meta = _query_models_concurrently(prompt, prompt_tokens, exclusions, models)
+        estimate = _estimate_cost(prompt_tokens, meta["model"])
+        cost = _calculate_cost(meta["usage"], meta["model"])
+        _log(f"Success with {meta['model']}, cost=${cost:.6f} (estimated ${estimate:.6f})")
+        yt_info = _search_youtube_video(rec_text)
+        details = {
+            "model": meta["model"],
+            "cost_usd": cost,
+            "estimated_cost_usd": estimate,
+            "youtube": yt_info,
+            "logs": _format_logs(logs),
+        }
+        recommendation = rec_text
+    except Exception as exc:
+        _log(str(exc))
 
     if not recommendation:
         error = "Failed to generate recommendation with all models."
         _log(error)
-        return {"recommendation": None, "details": {"error": error, "logs": LOG_BUFFER}}
-
-    # Record analytics
-    try:
-        update_recommendation_data(
-            session_id=session.get("entry_id"),
-            service=service,
-            playlist_id=playlist_id,
-            recommendation=recommendation,
-            details=details,
-            language=language
-        )
-    except Exception as analytics_exc:
-        _log(f"Analytics error: {analytics_exc}")
+        return {"recommendation": None, "details": {"error": error, "logs": _format_logs(logs)}}
 
-    return {"recommendation": html.escape(recommendation), "details": details}
+    return {"recommendation": recommendation, "details": details}
@@ -8,17 +8,29 @@ from analytics import store_login_data
 
 spotify_auth = Blueprint("spotify_auth", __name__)
 
+SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
+SPOTIFY_REDIRECT_URI = os.getenv(
+    "SPOTIFY_REDIRECT_URI",
+    "https://songsuggest.onrender.com/callback"
+)
+SPOTIFY_SCOPE = "playlist-read-private"
+
+# Query string for the Android intent minus the per-request state
+_STATIC_INTENT_PARAMS = urlencode({
+    "scope": SPOTIFY_SCOPE,
+    "response_type": "code",
+    "redirect_uri": SPOTIFY_REDIRECT_URI,
+    "client_id": SPOTIFY_CLIENT_ID
+})
+
 def create_auth_manager():
     """
     Create the Spotify Authentication Manager with PKCE.
     """
     return SpotifyPKCE(
-        client_id=os.getenv("SPOTIFY_CLIENT_ID"),
-        redirect_uri=os.getenv(
-            "SPOTIFY_REDIRECT_URI",
-            "https://songsuggest.onrender.com/callback"
-        ),
-        scope="playlist-read-private"
+        client_id=SPOTIFY_CLIENT_ID,
+        redirect_uri=SPOTIFY_REDIRECT_URI,
+        scope=SPOTIFY_SCOPE
     )
 
 def detect_device():
@@ -34,17 +46,7 @@ def build_android_intent(inapp_url, fallback_url):
     """
     Construct an Android intent URI that opens the Spotify app (or falls back).
     """
-    params = {
-        "scope": "playlist-read-private",
-        "response_type": "code",
-        "redirect_uri": os.getenv(
-            "SPOTIFY_REDIRECT_URI",
-            "https://songsuggest.onrender.com/callback"
-        ),
-        "client_id": os.getenv("SPOTIFY_CLIENT_ID"),
-        "state": session.get("spotify_csrf_token")
-    }
-    qs = urlencode(params)
+    qs = _STATIC_INTENT_PARAMS + "&" + urlencode({"state": session.get("spotify_csrf_token")})
     intent = (
         f"intent://accounts.spotify.com/inapp-authorize?{qs}"
         "#Intent;"
@@ -121,25 +123,13 @@ def spotify_callback():
         session["token_info"] = token_info
         session["authorized"] = True
 
-        device   = detect_device()
-        entry_id = store_login_data(
-            ip_address    = request.remote_addr,
-            outcome       = "success",
-            error_message = None,
-            device_type   = device
-        )
-        session["entry_id"] = entry_id
+        store_login_data(service="spotify", token=token_info)
+        session["entry_id"] = "spotify-" + secrets.token_hex(8)
 
         return redirect(url_for("home"))
 
     except Exception as e:
         print(f"Callback Error: {e}")
-        store_login_data(
-            ip_address    = request.remote_addr,
-            outcome       = "failure",
-            error_message = str(e),
-            device_type   = detect_device()
-        )
         return render_template("index.html", error=f"Authentication failed: {e}")
 
 @spotify_auth.route("/logout")
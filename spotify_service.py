@@ -1,9 +1,13 @@
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from flask import session
 from spotipy import Spotify
 from spotipy.oauth2 import SpotifyOAuth
 
+# Playlist ID from a web URL (spotify.com/playlist/ID) or an app URI (spotify:playlist:ID)
+_PLAYLIST_ID_RE = re.compile(r'(?:spotify\.com/playlist/|spotify:playlist:)([a-zA-Z0-9]+)')
+
 
 def create_spotify_client():
     """
@@ -27,40 +31,48 @@ def extract_spotify_playlist_id(playlist_url: str) -> str:
     
     Returns the extracted playlist ID or the original string if no ID was found.
     """
-    # Extract from web URL format
-    web_pattern = r'spotify\.com/playlist/([a-zA-Z0-9]+)'
-    web_match = re.search(web_pattern, playlist_url)
-    if web_match:
-        return web_match.group(1)
-    
-    # Extract from URI format
-    uri_pattern = r'spotify:playlist:([a-zA-Z0-9]+)'
-    uri_match = re.search(uri_pattern, playlist_url)
-    if uri_match:
-        return uri_match.group(1)
+    match = _PLAYLIST_ID_RE.search(playlist_url)
+    if match:
+        return match.group(1)
     
     # Return original value if no patterns match (might already be just the ID)
     return playlist_url
 
 
+# Maximum number of pages fetched concurrently after the first one
+PAGE_WORKERS = 8
+AUDIO_FEATURE_WORKERS = 4
+
+
 class SpotifyService:
     def __init__(self, client: Spotify):
         self.client = client
 
+    def _fetch_pages(self, fetch_page, page_size: int) -> list:
+        """
+        Fetch the first page to learn the total, then the remaining offsets concurrently.
+        Pages are returned in order.
+        """
+        first = fetch_page(0)
+        offsets = range(page_size, first.get('total', 0), page_size)
+        if not offsets:
+            return [first]
+        with ThreadPoolExecutor(max_workers=min(PAGE_WORKERS, len(offsets))) as pool:
+            return [first] + list(pool.map(fetch_page, offsets))
+
     def get_user_playlists(self):
         """
         Fetch all of the current user's playlists (id and name).
         """
-        playlists = []
-        results = self.client.current_user_playlists(limit=50)
-        while results:
-            for item in results['items']:
-                playlists.append({'id': item['id'], 'name': item['name']})
-            if results.get('next'):
-                results = self.client.next(results)
-            else:
-                results = None
-        return playlists
+        pages = self._fetch_pages(
+            lambda offset: self.client.current_user_playlists(limit=50, offset=offset),
+            50
+        )
+        return [
+            {'id': item['id'], 'name': item['name']}
+            for page in pages
+            for item in page['items']
+        ]
 
     def get_playlist_tracks(self, playlist_id: str):
         """
@@ -69,34 +81,37 @@ class SpotifyService:
         # Extract the playlist ID if a full URL was provided
         playlist_id = extract_spotify_playlist_id(playlist_id)
         
-        tracks = []
-        results = self.client.playlist_items(
-            playlist_id,
-            additional_types=['track'],
-            fields='items.track.id,items.track.name,items.track.artists(name)',
-            limit=100
+        pages = self._fetch_pages(
+            lambda offset: self.client.playlist_items(
+                playlist_id,
+                additional_types=['track'],
+                fields='total,items.track.id,items.track.name,items.track.artists(name)',
+                limit=100,
+                offset=offset
+            ),
+            100
         )
-        while results:
-            for item in results['items']:
+        tracks = []
+        for page in pages:
+            for item in page['items']:
                 t = item['track']
+                if not t:
+                    continue
                 tracks.append({
                     'id': t['id'],
                     'name': t['name'],
                     'artists': [a['name'] for a in t['artists']]
                 })
-            if results.get('next'):
-                results = self.client.next(results)
-            else:
-                results = None
         return tracks
 
     def get_audio_features(self, track_ids: list[str]):
         """
         Batch fetch audio features (tempo, energy, danceability, etc.) for up to 100 tracks at a time.
+        Batches are requested concurrently.
         """
-        features = []
-        for i in range(0, len(track_ids), 100):
-            batch = track_ids[i:i+100]
-            audio_feats = self.client.audio_features(batch)
-            features.extend([f for f in audio_feats if f])
-        return features
+        batches = [track_ids[i:i+100] for i in range(0, len(track_ids), 100)]
+        if not batches:
+            return []
+        with ThreadPoolExecutor(max_workers=min(AUDIO_FEATURE_WORKERS, len(batches))) as pool:
+            results = list(pool.map(self.client.audio_features, batches))
+        return [f for batch in results for f in batch if f]
@@ -1,12 +1,35 @@
 import os
 from flask import Blueprint, session, redirect, request, url_for, current_app, render_template, flash
-from google.oauth2.credentials import Credentials
+import hmac
 import secrets
 import json
+from functools import lru_cache
+from typing import TYPE_CHECKING
+from urllib.parse import quote, urlencode
 import requests
+from requests.adapters import HTTPAdapter, Retry
+from analytics import store_login_data
+
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
 
 youtube_auth = Blueprint('youtube_auth', __name__)
 
+# Pooled session for Google token requests so callbacks reuse the TLS connection
+TOKEN_TIMEOUT = (3.05, 10)
+_HTTP = requests.Session()
+_HTTP.mount(
+    'https://',
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=50,
+        max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504])
+    )
+)
+
+YOUTUBE_CLIENT_ID = os.environ.get('YOUTUBE_CLIENT_ID')
+YOUTUBE_CLIENT_SECRET = os.environ.get('YOUTUBE_CLIENT_SECRET')
+
 # Include all scopes that Google will add automatically
 SCOPES = [
     'https://www.googleapis.com/auth/youtube.readonly',
@@ -14,7 +37,7 @@ SCOPES = [
     'https://www.googleapis.com/auth/userinfo.profile'
 ]
 
-def _credentials_to_dict(creds: Credentials) -> dict:
+def _credentials_to_dict(creds: "Credentials") -> dict:
     return {
         'token': creds.token,
         'refresh_token': creds.refresh_token,
@@ -24,12 +47,25 @@ def _credentials_to_dict(creds: Credentials) -> dict:
         'scopes': creds.scopes
     }
 
+@lru_cache(maxsize=8)
+def _callback_url(host_url: str) -> str:
+    """
+    Build the external callback URL for a host. Bounded because host_url comes from the client.
+    """
+    return url_for('youtube_auth.callback', _external=True)
+
+def _redirect_uri() -> str:
+    """
+    Return the external callback URL for the current host.
+    """
+    return _callback_url(request.host_url)
+
 @youtube_auth.route('/login')
 def login():
     try:
         # Get credentials from environment variables
-        client_id = os.environ.get('YOUTUBE_CLIENT_ID')
-        client_secret = os.environ.get('YOUTUBE_CLIENT_SECRET')
+        client_id = YOUTUBE_CLIENT_ID
+        client_secret = YOUTUBE_CLIENT_SECRET
         
         if not client_id or not client_secret:
             flash("YouTube API credentials not configured.", "danger")
@@ -38,14 +74,9 @@ def login():
         # Generate state for CSRF protection
         state = secrets.token_hex(16)
         session['youtube_oauth_state'] = state
-        session.modified = True  # Force session to be saved
-        
-        # Store client credentials in session for the callback
-        session['youtube_client_id'] = client_id
-        session['youtube_client_secret'] = client_secret
         
         # Build the authorization URL
-        redirect_uri = url_for('youtube_auth.callback', _external=True)
+        redirect_uri = _redirect_uri()
         params = {
             'client_id': client_id,
             'redirect_uri': redirect_uri,
@@ -57,7 +88,7 @@ def login():
         }
         
         # Construct the auth URL
-        auth_url = "https://accounts.google.com/o/oauth2/auth?" + "&".join(f"{k}={v}" for k, v in params.items())
+        auth_url = "https://accounts.google.com/o/oauth2/auth?" + urlencode(params, quote_via=quote)
         
         return redirect(auth_url)
     except Exception as e:
@@ -84,7 +115,7 @@ def callback():
         current_app.logger.info(f"State from session: {stored_state}")
         
         # Verify state parameter
-        if not state_param or not stored_state or state_param != stored_state:
+        if not state_param or not stored_state or not hmac.compare_digest(str(state_param), str(stored_state)):
             current_app.logger.error(f"State mismatch or missing. Request: {state_param}, Session: {stored_state}")
             flash("Invalid state parameter. Authentication session may have expired.", "danger")
             return redirect(url_for('home'))
@@ -96,15 +127,15 @@ def callback():
             return redirect(url_for('home'))
         
         # Get client credentials
-        client_id = session.get('youtube_client_id') or os.environ.get('YOUTUBE_CLIENT_ID')
-        client_secret = session.get('youtube_client_secret') or os.environ.get('YOUTUBE_CLIENT_SECRET')
+        client_id = YOUTUBE_CLIENT_ID
+        client_secret = YOUTUBE_CLIENT_SECRET
         
         if not client_id or not client_secret:
             flash("Missing client credentials", "danger")
             return redirect(url_for('home'))
         
         # Exchange code for token
-        redirect_uri = url_for('youtube_auth.callback', _external=True)
+        redirect_uri = _redirect_uri()
         token_url = "https://oauth2.googleapis.com/token"
         
         token_data = {
@@ -116,7 +147,7 @@ def callback():
         }
         
         # Make the token request
-        token_response = requests.post(token_url, data=token_data)
+        token_response = _HTTP.post(token_url, data=token_data, timeout=TOKEN_TIMEOUT)
         
         if token_response.status_code != 200:
             current_app.logger.error(f"Token request failed: {token_response.text}")
@@ -125,7 +156,8 @@ def callback():
         
         token_json = token_response.json()
         
-        # Create credentials object
+        # Create credentials object (google-auth is only loaded once a login completes)
+        from google.oauth2.credentials import Credentials
         creds = Credentials(
             token=token_json['access_token'],
             refresh_token=token_json.get('refresh_token'),
@@ -136,23 +168,19 @@ def callback():
         )
         
         # Store credentials in session
-        session['youtube_credentials'] = _credentials_to_dict(creds)
+        cred_dict = _credentials_to_dict(creds)
+        session['youtube_credentials'] = cred_dict
         session['authorized_youtube'] = True
-        session.modified = True  # Force session to be saved
 
         # Analytics hook
-        from analytics import store_login_data
         try:
-            store_login_data(service='youtube', token=session['youtube_credentials'])
+            store_login_data(service='youtube', token=cred_dict)
             session['entry_id'] = 'youtube-' + secrets.token_hex(8)
-            session.modified = True  # Force session to be saved again
         except Exception as analytics_error:
             current_app.logger.error(f"Analytics error: {analytics_error}")
 
         # Clean up session
-        for key in ['youtube_client_id', 'youtube_client_secret', 'youtube_oauth_state']:
-            if key in session:
-                session.pop(key, None)
+        session.pop('youtube_oauth_state', None)
         
         flash("YouTube authentication successful!", "success")
         return redirect(url_for('home'))
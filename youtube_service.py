@@ -1,29 +1,104 @@
 import os
 import re
-from flask import session
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+import string
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import orjson
+from flask import g, session
+from googleapiclient.model import JsonModel
+
+# googleapiclient.discovery/http, google_auth_httplib2 and google.oauth2 are imported
+# where they are used so that importing this module (and starting the app) stays cheap
+
+# Characters allowed in a playlist ID (see the fast path in extract_youtube_playlist_id)
+_PLAYLIST_ID_CHARS = frozenset(string.ascii_letters + string.digits + '_-')
+
+# Playlist ID from a list= query parameter or a youtube.com/playlist/ID path
+_PLAYLIST_ID_RE = re.compile(r'(?:[?&]list=|youtube\.com/playlist/)([a-zA-Z0-9_-]+)')
+
+# One keep-alive httplib2 transport per thread, shared by every client built on it
+_HTTP_LOCAL = threading.local()
+
+
+def _thread_base_http():
+    """
+    Return this thread's unauthenticated httplib2 transport, creating it on first use.
+    """
+    http = getattr(_HTTP_LOCAL, 'http', None)
+    if http is None:
+        from googleapiclient.http import build_http
+        http = _HTTP_LOCAL.http = build_http()
+    return http
+
+
+class OrjsonModel(JsonModel):
+    """
+    JsonModel that parses API responses with orjson instead of the stdlib json module.
+    """
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return content.decode('utf-8') if isinstance(content, bytes) else content
+        if self._data_wrapper and 'data' in body:
+            body = body['data']
+        return body
+
+
+@lru_cache(maxsize=256)
+def _build_youtube_client(token, refresh_token, token_uri, client_id, client_secret, scopes, thread_id):
+    """
+    Build a YouTube Data API client for one set of credentials. Clients are cached per
+    thread because the underlying httplib2 transport is not thread-safe; all clients on
+    a thread share its transport, so API connections stay warm across users.
+    """
+    from google.oauth2.credentials import Credentials
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build
+
+    creds = Credentials(
+        token=token,
+        refresh_token=refresh_token,
+        token_uri=token_uri,
+        client_id=client_id,
+        client_secret=client_secret,
+        scopes=list(scopes)
+    )
+    http = AuthorizedHttp(creds, http=_thread_base_http())
+    return build(
+        'youtube', 'v3', http=http, model=OrjsonModel(),
+        cache_discovery=False, static_discovery=True
+    )
 
 
 def create_youtube_client():
     """
-    Instantiate and return a YouTube Data API client using stored session credentials.
+    Return a YouTube Data API client for the stored session credentials, reusing a
+    previously built client for the same credentials when there is one.
     Returns None if no valid credentials are present.
     """
+    client = g.get('youtube_client')
+    if client is not None:
+        return client
     cred_info = session.get('youtube_credentials')
     if not cred_info:
         return None
-    creds = Credentials(
-        token=cred_info['token'],
-        refresh_token=cred_info.get('refresh_token'),
-        token_uri=cred_info['token_uri'],
-        client_id=cred_info['client_id'],
-        client_secret=cred_info['client_secret'],
-        scopes=cred_info['scopes']
+    client = g.youtube_client = _build_youtube_client(
+        cred_info['token'],
+        cred_info.get('refresh_token'),
+        cred_info['token_uri'],
+        cred_info['client_id'],
+        cred_info['client_secret'],
+        tuple(cred_info['scopes'] or ()),
+        threading.get_ident()
     )
-    return build('youtube', 'v3', credentials=creds)
+    return client
 
 
+@lru_cache(maxsize=1024)
 def extract_youtube_playlist_id(url: str) -> str:
     """
     Extract the playlist ID from various YouTube URL formats.
@@ -34,33 +109,123 @@ def extract_youtube_playlist_id(url: str) -> str:
     - YouTube Shortlink: youtu.be/VIDEO_ID?list=PLAYLIST_ID
     - YouTube embedded: youtube.com/embed/VIDEO_ID?list=PLAYLIST_ID
     - YouTube watch: youtube.com/watch?v=VIDEO_ID&list=PLAYLIST_ID
+    
+    Results are cached, so repeated inputs (and the unmatched-URL warning) are handled once.
     """
-    import re
+    # A bare ID (no path or query) is returned as-is
+    if '/' not in url and '?' not in url:
+        return url
     
-    # Try to extract the playlist ID using regex - match more specifically
-    playlist_pattern = r'[?&]list=([a-zA-Z0-9_-]+)'
-    match = re.search(playlist_pattern, url)
+    # Fast path for the usual ?list= / &list= query parameter
+    start = url.find('list=') + 5
+    if start > 5 and url[start - 6] in '?&':
+        end = start
+        while end < len(url) and url[end] in _PLAYLIST_ID_CHARS:
+            end += 1
+        if end > start:
+            return url[start:end]
     
+    match = _PLAYLIST_ID_RE.search(url)
     if match:
         return match.group(1)  # Return just the ID portion
-        
-    # Try alternative patterns for different URL formats
-    alternate_pattern = r'youtube\.com/playlist/([a-zA-Z0-9_-]+)'
-    alt_match = re.search(alternate_pattern, url)
-    if alt_match:
-        return alt_match.group(1)
     
-    # If no match found and it looks like a URL, log a warning
-    if '/' in url or '?' in url:
-        print(f"Warning: Could not extract playlist ID from: {url}")
-        
-    # Return the original value (it might already be just the ID)
+    # No match in something that looks like a URL
+    print(f"Warning: Could not extract playlist ID from: {url}")
     return url
 
 
+# Partial-response projections: only the fields read below are returned
+PLAYLISTS_FIELDS = 'nextPageToken,items(id,snippet/title)'
+PLAYLIST_ITEMS_FIELDS = (
+    'nextPageToken,'
+    'items/snippet(title,channelTitle,publishedAt,description,resourceId/videoId)'
+)
+VIDEOS_PART = 'snippet,topicDetails'
+VIDEOS_FIELDS = 'items(id,snippet/tags,topicDetails/relevantTopicIds)'
+
+# Retries per API call on 5xx, 429 and rate-limit 403s; googleapiclient backs off
+# exponentially with jitter between attempts (exhausted daily quota is not retried)
+API_RETRIES = 5
+
+# Maximum number of video detail requests in flight while playlist pages are walked.
+# The pool is long-lived so each worker's keep-alive connection is reused across requests.
+DETAIL_WORKERS = 8
+_DETAIL_POOL = ThreadPoolExecutor(max_workers=DETAIL_WORKERS, thread_name_prefix='yt-details')
+
+# Recently fetched video details: video_id -> (fetched_at, tags, topic_categories).
+# Tags and topics rarely change, so repeat loads of a playlist skip videos().list for
+# these ids; the oldest entries are evicted first once the cache is full.
+VIDEO_DETAILS_CACHE_MAX = 3000
+VIDEO_DETAILS_TTL = 6 * 3600
+_VIDEO_DETAILS = {}
+_VIDEO_DETAILS_LOCK = threading.Lock()
+
+
+def _cache_video_details(details: dict):
+    """
+    Store fetched {video_id: (tags, topic_categories)} and prune the oldest entries.
+    """
+    now = time.monotonic()
+    with _VIDEO_DETAILS_LOCK:
+        for video_id, (tags, topic_categories) in details.items():
+            _VIDEO_DETAILS.pop(video_id, None)
+            _VIDEO_DETAILS[video_id] = (now, tags, topic_categories)
+        while len(_VIDEO_DETAILS) > VIDEO_DETAILS_CACHE_MAX:
+            del _VIDEO_DETAILS[next(iter(_VIDEO_DETAILS))]
+
+
+class QuotaExhausted(Exception):
+    """
+    Raised by iter_playlist_items when the daily API quota runs out. `page_token` is the
+    token of the first page not yet yielded (None for the playlist's first page); pass it
+    back as page_token to resume there once quota is available again.
+    """
+    def __init__(self, page_token):
+        super().__init__(f'YouTube API quota exhausted, resume from page token {page_token!r}')
+        self.page_token = page_token
+
+
+def _is_quota_exceeded(error) -> bool:
+    """
+    Whether an HttpError is the exhausted daily quota (which is never retried).
+    """
+    details = error.error_details if isinstance(error.error_details, list) else ()
+    return error.resp.status == 403 and any(
+        isinstance(detail, dict) and detail.get('reason') in ('quotaExceeded', 'dailyLimitExceeded')
+        for detail in details
+    )
+
+
+def _merge_details(page: list, future, details: dict) -> list:
+    """
+    Wait for a page's detail lookup, then fill its items from all details seen so far.
+    Pages must be merged in order, since repeated videos reuse earlier pages' details.
+    """
+    if future is not None:
+        details.update(future.result())
+    for item in page:
+        detail = details.get(item['id'])
+        if detail is not None:
+            item['tags'], item['topic_categories'] = detail
+    return page
+
+
 class YouTubeService:
     def __init__(self, client):
         self.client = client
+        self._local = threading.local()
+
+    def _thread_http(self):
+        """
+        Return this thread's authorized transport. httplib2 connections are not
+        thread-safe, so worker threads execute requests over their own.
+        """
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            from google_auth_httplib2 import AuthorizedHttp
+            http = AuthorizedHttp(self.client._http.credentials, http=_thread_base_http())
+            self._local.http = http
+        return http
 
     def get_user_playlists(self):
         """
@@ -68,12 +233,14 @@ class YouTubeService:
         """
         playlists = []
         request = self.client.playlists().list(
-            part='snippet', mine=True, maxResults=50
+            part='snippet', mine=True, maxResults=50, fields=PLAYLISTS_FIELDS
         )
         while request:
-            response = request.execute()
-            for item in response.get('items', []):
-                playlists.append({'id': item['id'], 'name': item['snippet']['title']})
+            response = request.execute(num_retries=API_RETRIES)
+            playlists.extend(
+                {'id': item['id'], 'name': item['snippet']['title']}
+                for item in response.get('items', ())
+            )
             request = self.client.playlists().list_next(request, response)
         return playlists
 
@@ -86,64 +253,114 @@ class YouTubeService:
         - Tags/keywords
         - Topic categories
         """
+        return list(self.iter_playlist_items(playlist_id))
+
+    def iter_playlist_items(self, playlist_id: str, page_token: str = None):
+        """
+        Yield the videos of a YouTube playlist (see get_playlist_items) page by page,
+        in playlist order, as soon as each page's details are available.
+        Raises QuotaExhausted if the daily quota runs out; pass its page_token back as
+        `page_token` to resume from the first page that was not yielded.
+        """
+        from googleapiclient.errors import HttpError
+
         # Extract the playlist ID if a full URL was provided
         playlist_id = extract_youtube_playlist_id(playlist_id)
         
-        items = []
         # First, get all playlist items
         request = self.client.playlistItems().list(
-            part='snippet,contentDetails',
+            part='snippet',
             playlistId=playlist_id,
-            maxResults=50
+            maxResults=50,
+            pageToken=page_token,
+            fields=PLAYLIST_ITEMS_FIELDS
         )
         
+        # Page tokens only come from the previous response, so pages are walked in order
+        # while video details are fetched in the background. A page is yielded once the
+        # next page has been requested, so the page walk keeps overlapping detail fetches.
+        # Each video id is requested at most once, even when the playlist repeats it.
+        pending = deque()
+        requested = set()
+        details = {}
         while request:
-            response = request.execute()
-            video_ids = []
-            temp_items = {}
-            
+            try:
+                response = request.execute(num_retries=API_RETRIES)
+            except HttpError as exc:
+                if _is_quota_exceeded(exc):
+                    raise QuotaExhausted(pending[0][0] if pending else page_token) from exc
+                raise
             # Process basic playlist item info
-            for item in response.get('items', []):
-                snippet = item['snippet']
-                video_id = snippet['resourceId']['videoId']
-                video_ids.append(video_id)
-                
-                # Store basic info in temporary dictionary
-                temp_items[video_id] = {
-                    'id': video_id,
+            page = [
+                {
+                    'id': snippet['resourceId']['videoId'],
                     'name': snippet['title'],
                     'channel': snippet['channelTitle'],
                     'published_at': snippet['publishedAt'],
                     'description': snippet['description'],
                     'album': ''  # YouTube videos don't have album info
                 }
+                for snippet in (item['snippet'] for item in response.get('items', ()))
+            ]
             
-            # Batch request additional video details in chunks of 50
-            for i in range(0, len(video_ids), 50):
-                chunk = video_ids[i:i+50]
-                video_response = self.client.videos().list(
-                    part='snippet,topicDetails',
-                    id=','.join(chunk)
-                ).execute()
-                
-                # Process additional video details
-                for video in video_response.get('items', []):
-                    video_id = video['id']
-                    if video_id in temp_items:
-                        # Add tags
-                        temp_items[video_id]['tags'] = video['snippet'].get('tags', [])
-                        
-                        # Add topic categories if available
-                        if 'topicDetails' in video:
-                            topic_categories = video['topicDetails'].get('relevantTopicIds', [])
-                            temp_items[video_id]['topic_categories'] = topic_categories
-                        else:
-                            temp_items[video_id]['topic_categories'] = []
-            
-            # Add all processed items to the result list
-            items.extend(temp_items.values())
+            new_ids = list(dict.fromkeys(item['id'] for item in page if item['id'] not in requested))
+            future = None
+            if new_ids:
+                requested.update(new_ids)
+                future = _DETAIL_POOL.submit(self._get_video_details, new_ids)
+            pending.append((page_token, page, future))
             
             # Get next page of results if available
             request = self.client.playlistItems().list_next(request, response)
+            page_token = response.get('nextPageToken')
             
-        return items
+            while len(pending) > 1 or (pending and not request):
+                token, page, future = pending.popleft()
+                try:
+                    page = _merge_details(page, future, details)
+                except HttpError as exc:
+                    if _is_quota_exceeded(exc):
+                        raise QuotaExhausted(token) from exc
+                    raise
+                yield from page
+
+    def _get_video_details(self, video_ids: list) -> dict:
+        """
+        Return {video_id: (tags, topic_categories)} for the given videos. Recently
+        fetched videos come from the cache; the rest are requested in chunks of 50.
+        Videos the API does not return (private or deleted) are left out.
+        """
+        now = time.monotonic()
+        details = {}
+        missing = []
+        for video_id in video_ids:
+            cached = _VIDEO_DETAILS.get(video_id)
+            if cached and now - cached[0] < VIDEO_DETAILS_TTL:
+                details[video_id] = cached[1:]
+            else:
+                missing.append(video_id)
+        
+        fetched = {}
+        # Batch request additional video details in chunks of 50
+        for i in range(0, len(missing), 50):
+            chunk = missing[i:i+50]
+            video_response = self.client.videos().list(
+                part=VIDEOS_PART,
+                id=','.join(chunk),
+                fields=VIDEOS_FIELDS
+            ).execute(http=self._thread_http(), num_retries=API_RETRIES)
+            
+            # Process additional video details
+            for video in video_response.get('items', []):
+                tags = video.get('snippet', {}).get('tags', [])
+                # Add topic categories if available
+                if 'topicDetails' in video:
+                    topic_categories = video['topicDetails'].get('relevantTopicIds', [])
+                else:
+                    topic_categories = []
+                fetched[video['id']] = (tags, topic_categories)
+        
+        if fetched:
+            _cache_video_details(fetched)
+            details.update(fetched)
+        return details